@@ -1,59 +1,182 @@
 import os
+import hmac
+import hashlib
 import json
+import decimal
+import logging
+import logging.handlers
+import queue
+import atexit
+import orjson
+import time
+import select
+import socket
+import threading
 from dotenv import load_dotenv
 from flask import (
     Flask, request, render_template,
-    redirect, url_for, flash, jsonify
+    redirect, url_for, flash, jsonify, abort, Response
 )
+from flask.json.provider import JSONProvider
+from markupsafe import Markup
+from werkzeug.routing import BaseConverter
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from flask_compress import Compress
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime
 from functools import wraps
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Mapping, Optional
 from urllib.parse import quote_plus # Keep import, might be needed later
-from datetime import datetime, timedelta, timezone # Added timedelta and timezone
+from datetime import datetime, timedelta # timedelta: recent awaiting_payment cutoff in vending_interface
 
 # --- Load Environment Variables ---
 load_dotenv()
 
+# --- Logging (lazy %-formatting: per-request debug lines cost nothing unless DEBUG is enabled) ---
+# Request threads only enqueue records; a background QueueListener does the blocking stream writes.
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+_log_queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+_log_queue_handler.setFormatter(logging.Formatter('%(message)s')) # prepare() merges args into msg; the stream handler adds time/level
+_log_listener = None
+
+def _start_log_listener():
+    # Threads don't survive fork, so gunicorn workers (preload_app) call this again to get their own queue + drain thread
+    global _log_listener
+    _log_queue_handler.queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(_log_queue_handler.queue, _log_stream_handler)
+    _log_listener.start()
+
+_start_log_listener()
+os.register_at_fork(after_in_child=_start_log_listener)
+atexit.register(lambda: _log_listener.stop()) # flush queued records on shutdown
+logging.basicConfig(level=logging.INFO, handlers=[_log_queue_handler])
+logger = logging.getLogger('vending')
+
 # --- Initialize Flask App ---
 app = Flask(__name__)
 
-# --- Configure App ---
-db_url = os.environ.get('DATABASE_URL')
-if not db_url:
-    raise ValueError("DATABASE_URL environment variable not set.")
-if db_url.startswith("postgres://"):
-    db_url = db_url.replace("postgres://", "postgresql://", 1)
-
-secret_key = os.environ.get('SECRET_KEY')
-if not secret_key:
-    print("Warning: SECRET_KEY not set. Using insecure default.")
-    secret_key = 'your_actual_secret_key_here_flask' # CHANGE THIS in .env for Flask sessions/flash
-
-app.config['SQLALCHEMY_DATABASE_URI'] = db_url
+class MachineIdConverter(BaseConverter):
+    """URL segment for a machine ID: 1-80 chars (Product.machine_id is String(80)), no slashes or control chars."""
+    regex = r'[^/\x00-\x1f]{1,80}'
+
+app.url_map.converters['machine'] = MachineIdConverter
+
+# --- Configure App (all env vars are read and parsed ONCE here) ---
+@dataclass(frozen=True, slots=True)
+class Config:
+    db_url: str
+    secret_key: str
+    macrodroid_api_key: Optional[str]
+    account_map: Mapping[str, str]
+    db_pool_size: int
+    db_max_overflow: int
+    long_poll_max_waiters: int
+    port: int
+    debug: bool
+
+def _load_config():
+    db_url = os.environ.get('DATABASE_URL')
+    if not db_url:
+        raise ValueError("DATABASE_URL environment variable not set.")
+    if db_url.startswith("postgres://"):
+        db_url = db_url.replace("postgres://", "postgresql://", 1)
+
+    secret_key = os.environ.get('SECRET_KEY')
+    if not secret_key:
+        logger.warning("Warning: SECRET_KEY not set. Using insecure default.")
+        secret_key = 'your_actual_secret_key_here_flask' # CHANGE THIS in .env for Flask sessions/flash
+
+    # --- Load Vending Specific Config ---
+    macrodroid_api_key = os.environ.get('MACRODROID_API_KEY')
+    if not macrodroid_api_key:
+        logger.critical("CRITICAL WARNING: MACRODROID_API_KEY environment variable not set. Payment endpoint is insecure and will fail!")
+
+    # Optional: Load account mapping - NOT used by this test /buy route, but maybe needed elsewhere
+    aba_account_mapping_json = os.environ.get('ABA_ACCOUNT_MAPPING', '{}')
+    try:
+        account_map = json.loads(aba_account_mapping_json)
+        if not isinstance(account_map, dict):
+            raise ValueError("ABA_ACCOUNT_MAPPING is not a valid JSON object.")
+        logger.info("Loaded ABA Account Mapping (for reference): %s", account_map)
+    except (json.JSONDecodeError, ValueError) as e:
+        logger.warning("WARNING: Could not parse ABA_ACCOUNT_MAPPING JSON: %s. Using empty map.", e)
+        account_map = {}
+
+    return Config(
+        db_url=db_url, secret_key=secret_key, macrodroid_api_key=macrodroid_api_key,
+        account_map=MappingProxyType(account_map), # Read-only view, config never changes after boot
+        db_pool_size=int(os.environ.get('DB_POOL_SIZE', 10)),
+        db_max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        # Per worker, kept well below GUNICORN_THREADS (see gunicorn.conf.py) so unauthenticated ?wait= polls can't
+        # occupy every thread and starve /payment-received and the customer pages
+        long_poll_max_waiters=int(os.environ.get('LONG_POLL_MAX_WAITERS', max(1, int(os.environ.get('GUNICORN_THREADS', 4)) // 4))),
+        port=int(os.environ.get('PORT', 5000)),
+        debug=os.environ.get('FLASK_DEBUG', '0') == '1'
+    )
+
+CONFIG = _load_config()
+logger.setLevel(logging.DEBUG if CONFIG.debug else logging.INFO)
+
+app.config['SQLALCHEMY_DATABASE_URI'] = CONFIG.db_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.secret_key = secret_key # Used for Flask flash messages etc.
-
-# --- Load Vending Specific Config ---
-MACRODROID_API_KEY = os.environ.get('MACRODROID_API_KEY')
-if not MACRODROID_API_KEY:
-    print("CRITICAL WARNING: MACRODROID_API_KEY environment variable not set. Payment endpoint is insecure and will fail!")
-
-# Optional: Load account mapping - NOT used by this test /buy route, but maybe needed elsewhere
-ABA_ACCOUNT_MAPPING_JSON = os.environ.get('ABA_ACCOUNT_MAPPING', '{}')
-try:
-    ACCOUNT_NUMBER_TO_MACHINE_ID = json.loads(ABA_ACCOUNT_MAPPING_JSON)
-    if not isinstance(ACCOUNT_NUMBER_TO_MACHINE_ID, dict):
-        raise ValueError("ABA_ACCOUNT_MAPPING is not a valid JSON object.")
-    print(f"Loaded ABA Account Mapping (for reference): {ACCOUNT_NUMBER_TO_MACHINE_ID}")
-except (json.JSONDecodeError, ValueError) as e:
-    print(f"WARNING: Could not parse ABA_ACCOUNT_MAPPING JSON: {e}. Using empty map.")
-    ACCOUNT_NUMBER_TO_MACHINE_ID = {}
+if not CONFIG.db_url.startswith('sqlite'): # SQLite uses its own pool classes, which reject these arguments
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': CONFIG.db_pool_size,       # per gunicorn worker; covers its threads + the LISTEN connection
+        'max_overflow': CONFIG.db_max_overflow,
+        'pool_pre_ping': True,                  # drop connections the server closed instead of failing the request
+        'pool_recycle': 280,                    # seconds; stay under managed-PG's ~5 min idle disconnect
+        'pool_use_lifo': True,                  # reuse the hottest connections, let the rest idle out
+    }
+app.secret_key = CONFIG.secret_key # Used for Flask flash messages etc.
+
+# --- JSON via orjson (C extension) for all jsonify() responses, incl. the ESP32 polling endpoints ---
+def _orjson_default(o):
+    if isinstance(o, decimal.Decimal): return str(o) # Same as Flask's default provider
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+class ORJSONProvider(JSONProvider):
+    def dumps(self, obj, **kwargs): return orjson.dumps(obj, default=_orjson_default).decode('utf-8')
+    def loads(self, s, **kwargs): return orjson.loads(s)
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the Response (skips the str round-trip of the base class)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=_orjson_default), mimetype="application/json")
+
+app.json = ORJSONProvider(app)
+
+# Constant JSON replies, serialized once at import: (body_bytes, status)
+def _json_body(obj, status): return orjson.dumps(obj), status
+_JSON_NO_API_KEY_SETUP = _json_body({"error": "Server configuration error: Missing API Key setup"}, 503) # Service Unavailable
+_JSON_BAD_API_KEY = _json_body({"error": "Unauthorized: Invalid API Key"}, 401)
+_JSON_NOT_JSON = _json_body({"error": "Request must be JSON"}, 400)
+_JSON_NO_MACHINE_ID = _json_body({"error": "Missing 'machine_id'"}, 400)
+_JSON_INTERNAL_ERROR = _json_body({"error": "Internal server error"}, 500)
+_JSON_NO_VEND_ID = _json_body({"error": "vend_id is required"}, 400)
+_JSON_NO_COMMAND = _json_body({"motor_id": None, "command_id": None}, 200) # the common /get_command poll reply
+_JSON_DB_ERROR = _json_body({"error": "Database error"}, 500)
+_JSON_ACK_MISSING_FIELDS = _json_body({"error": "Missing fields"}, 400)
+_JSON_ACK_BAD_STATUS = _json_body({"error": "Invalid status"}, 400)
+_JSON_ACK_BAD_FIELDS = _json_body({"error": "Invalid field types"}, 400)
+_JSON_ACK_OK = _json_body({"message": "Acknowledgment received"}, 200)
+_JSON_ACK_NOT_FOUND = _json_body({"error": "Command not found"}, 404)
+_JSON_ACK_VEND_MISMATCH = _json_body({"error": "Vending machine ID mismatch"}, 400)
+_JSON_ACK_DB_ERROR = _json_body({"error": "Database error during acknowledgment"}, 500)
+
+def _json_static(packed):
+    body, status = packed
+    return app.response_class(body, status=status, mimetype="application/json")
 
 
 # --- Initialize DB and Migrate ---
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
+app.config['COMPRESS_BR_LEVEL'] = 5 # brotli quality (Flask-Compress default 4): a little denser HTML for negligible CPU
+app.config['COMPRESS_BR_MODE'] = 1  # brotli MODE_TEXT: everything large enough to compress here is HTML/JSON
+Compress(app) # gzip/brotli for HTML pages (product lists); tiny JSON replies stay below the size threshold
 
 # --- Database Models (NO payment_url column needed for this test version) ---
 class Product(db.Model):
@@ -61,7 +184,7 @@ class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     machine_id = db.Column(db.String(80), nullable=False, index=True)
     name = db.Column(db.String(100), nullable=False)
-    price = db.Column(db.Float, nullable=False)
+    price = db.Column(db.Numeric(10, 2), nullable=False) # exact money; comes back as Decimal
     stock = db.Column(db.Integer, nullable=False, default=0)
     description = db.Column(db.Text, nullable=True)
     motor_id = db.Column(db.Integer, nullable=False)
@@ -69,19 +192,26 @@ class Product(db.Model):
     # payment_url = db.Column(db.String(512), nullable=True) # <- Field NOT ADDED for this test
 
     __table_args__ = (db.UniqueConstraint('machine_id', 'motor_id', name='uq_machine_motor_product'),)
-    commands = db.relationship('VendCommand', backref='product_commanded', lazy='dynamic')
-    transactions = db.relationship('Transaction', backref='product_transacted', lazy='dynamic')
+    # lazy='raise': the customer/admin paths never iterate these, so any accidental access fails loudly
+    # instead of emitting SQL. Use an explicit selectinload() if a view ever needs them.
+    commands = db.relationship('VendCommand', back_populates='product_commanded', lazy='raise')
+    transactions = db.relationship('Transaction', back_populates='product_transacted', lazy='raise')
     def __repr__(self): return f'<Product {self.id}: {self.name} (Machine: {self.machine_id}, Motor: {self.motor_id})>'
 
 class VendCommand(db.Model):
     __tablename__ = 'vend_command'
     id = db.Column(db.Integer, primary_key=True)
-    vend_id = db.Column(db.String(80), nullable=False, index=True) # Machine ID (e.g., "v3")
+    vend_id = db.Column(db.String(80), nullable=False) # Machine ID (e.g., "v3") - indexed via ix_vendcmd_vend_status_created
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     motor_id = db.Column(db.Integer, nullable=False)
     status = db.Column(db.String(40), nullable=False, default='awaiting_payment', index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     acknowledged_at = db.Column(db.DateTime, nullable=True)
+    # Loaded on demand (no view reads it), so the hot ESP32 queries never JOIN product
+    product_commanded = db.relationship('Product', back_populates='commands', lazy='select')
+
+    # Matches every hot lookup: WHERE vend_id = ? AND status = ? ORDER BY created_at [DESC] LIMIT 1
+    __table_args__ = (db.Index('ix_vendcmd_vend_status_created', vend_id, status, created_at.desc()),)
     def __repr__(self): return f'<Command {self.id} for Vend {self.vend_id} - Prod {self.product_id} / Motor {self.motor_id} ({self.status})>'
 
 class Transaction(db.Model):
@@ -89,31 +219,56 @@ class Transaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     quantity = db.Column(db.Integer, nullable=False, default=1)
-    amount_paid = db.Column(db.Float, nullable=False)
+    amount_paid = db.Column(db.Numeric(10, 2), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    product_transacted = db.relationship('Product', back_populates='transactions', lazy='select')
+    # Postgres doesn't index FKs: covers delete_product's EXISTS check, the FK check on product delete,
+    # and per-product sales-by-time range scans
+    __table_args__ = (db.Index('ix_transaction_product_ts', product_id, timestamp),)
     def __repr__(self): return f'<Transaction {self.id} for Prod {self.product_id} @ {self.timestamp}>'
 
 # --- Decorator for API Key Authentication ---
+# Encoded once so each request only does a constant-time bytes compare
+_MACRODROID_API_KEY_BYTES = (CONFIG.macrodroid_api_key or '').encode('utf-8')
+_API_KEY_CONFIGURED = bool(CONFIG.macrodroid_api_key)
+
 def require_api_key(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if not MACRODROID_API_KEY:
-            print("CRITICAL SECURITY ALERT: API Key decorator invoked but MACRODROID_API_KEY is NOT SET on the server!")
-            return jsonify({"error": "Server configuration error: Missing API Key setup"}), 503 # Service Unavailable
+        if not _API_KEY_CONFIGURED:
+            logger.critical("CRITICAL SECURITY ALERT: API Key decorator invoked but MACRODROID_API_KEY is NOT SET on the server!")
+            return _json_static(_JSON_NO_API_KEY_SETUP)
         api_key = request.headers.get('X-API-Key')
-        if not api_key or api_key != MACRODROID_API_KEY:
-            print(f"[AUTH-FAIL] '/{f.__name__}' endpoint: Invalid or missing API Key. Provided: '{api_key}'")
-            return jsonify({"error": "Unauthorized: Invalid API Key"}), 401 # Unauthorized
-        print(f"[AUTH-OK] '/{f.__name__}' endpoint: API Key verified.")
+        if not api_key or not hmac.compare_digest(api_key.encode('utf-8'), _MACRODROID_API_KEY_BYTES): # No early exit on mismatch (timing-safe)
+            logger.warning("[AUTH-FAIL] '/%s' endpoint: Invalid or missing API Key. Provided: '%s'", f.__name__, api_key)
+            return _json_static(_JSON_BAD_API_KEY)
+        logger.debug("[AUTH-OK] '/%s' endpoint: API Key verified.", f.__name__)
         return f(*args, **kwargs)
     return decorated_function
 
+# --- Helpers ---
+def _get_or_404(model, pk):
+    # Session.get hits the identity map first; replaces the legacy Model.query.get_or_404
+    obj = db.session.get(model, pk)
+    if obj is None: abort(404)
+    return obj
+
+_PRICE_CENTS = decimal.Decimal('0.01')
+_PRICE_MAX = decimal.Decimal('1e8') # Numeric(10, 2): at most 8 integer digits
+
+def _quantize_price(price):
+    # Round to the column scale BEFORE validating, so e.g. 0.004 (stored as 0.00) can't make a free product.
+    # Returns None when the rounded value isn't a storable positive price.
+    if not price.is_finite() or abs(price) >= _PRICE_MAX: return None
+    price = price.quantize(_PRICE_CENTS, rounding=decimal.ROUND_HALF_UP) # half away from zero, like Postgres numeric
+    return price if 0 < price < _PRICE_MAX else None
+
 # --- Routes ---
 
 # Simple Home Route
-@app.route('/')
-def home():
-    return """
+# Encoded once at import; a fresh Response wraps it per request (a shared Response object would be
+# mutated by Flask's after-request/session handling).
+HOME_HTML = b"""
     <h1>Minimal Vending App</h1>
     <p><a href="/admin/machines">View Machine IDs</a></p>
     <p><a href="/admin/products">Manage Product Slots</a></p>
@@ -121,14 +276,55 @@ def home():
     <p><strong>Customer View Example:</strong> Try <a href="/vending/v3">/vending/v3</a> (replace v3 with an ID you added)</p>
     """
 
+HOME_ETAG = hashlib.sha1(HOME_HTML).hexdigest() # Static page, so the ETag never changes while the process runs
+
+@app.route('/')
+def home():
+    response = Response(HOME_HTML, mimetype='text/html', headers={'Cache-Control': 'public, max-age=3600'})
+    response.set_etag(HOME_ETAG)
+    return response.make_conditional(request) # 304 with no body when the browser already has it
+
 # --- Admin Routes ---
 # (Keep your existing list_machines, list_products, add_product, edit_product, delete_product routes)
 # Ensure they DO NOT try to access product.payment_url since it doesn't exist in the DB model here
+# Loose index scan over ix_product_machine_id: one index probe per DISTINCT machine (O(K log N))
+# instead of reading every product row. Results come out already sorted.
+_DISTINCT_MACHINE_IDS_SQL = db.text("""
+    WITH RECURSIVE t AS (
+        SELECT min(machine_id) AS m FROM product
+        UNION ALL
+        SELECT (SELECT min(machine_id) FROM product WHERE machine_id > t.m) FROM t WHERE t.m IS NOT NULL
+    )
+    SELECT m FROM t WHERE m IS NOT NULL
+""")
+
+# Per-process cache of the distinct machine IDs. Product add/edit/delete bump _MACHINE_GEN so this worker
+# re-queries on the next hit; the TTL bounds staleness for mutations made by *other* gunicorn workers.
+MACHINE_CACHE_TTL_SECONDS = 60.0
+_MACHINE_CACHE = {'gen': -1, 'ids': None, 'loaded_at': 0.0}
+_MACHINE_GEN = 0
+_machine_cache_lock = threading.Lock()
+
+def _bump_machine_gen():
+    global _MACHINE_GEN
+    with _machine_cache_lock: _MACHINE_GEN += 1
+
+def _get_known_machines(max_age=MACHINE_CACHE_TTL_SECONDS):
+    """Sorted tuple of machine IDs that have products; re-queried only after a product mutation or once older than max_age."""
+    with _machine_cache_lock:
+        if _MACHINE_CACHE['gen'] == _MACHINE_GEN and time.monotonic() - _MACHINE_CACHE['loaded_at'] < max_age:
+            return _MACHINE_CACHE['ids']
+        gen = _MACHINE_GEN
+    ids = tuple(db.session.scalars(_DISTINCT_MACHINE_IDS_SQL).all()) # query outside the lock
+    with _machine_cache_lock:
+        if gen == _MACHINE_GEN: # don't store a result that a concurrent mutation already made stale
+            _MACHINE_CACHE.update(gen=gen, ids=ids, loaded_at=time.monotonic())
+    return ids
+
 @app.route('/admin/machines')
 def list_machines_from_products():
     try:
-        machine_ids_tuples = db.session.query(Product.machine_id).distinct().order_by(Product.machine_id).all()
-        machine_ids = [m[0] for m in machine_ids_tuples]
+        machine_ids = _get_known_machines()
     except Exception as e:
         flash(f"Error fetching machine IDs: {e}", "error")
         machine_ids = []
@@ -136,11 +332,15 @@ def list_machines_from_products():
 
 @app.route('/admin/products')
 def list_products():
-    try:
-        products = Product.query.order_by(Product.machine_id, Product.name).all()
-    except Exception as e:
-        flash(f"Error fetching products: {e}", "error")
-        products = []
+    with db.session.no_autoflush: # read-only view, skip the autoflush dirty-set check
+        try:
+            # Stream rows in batches while the template renders instead of loading the whole catalog.
+            # description/image_url are NOT deferred: the list template shows both (truncated), so deferring would lazy-load per row.
+            stmt = db.select(Product).order_by(Product.machine_id, Product.name).execution_options(yield_per=200)
+            products = db.session.scalars(stmt)
+        except Exception as e:
+            flash(f"Error fetching products: {e}", "error")
+            products = []
     # Pass products to a template that DOES NOT expect 'payment_url'
     return render_template('admin/products.html', products=products) # Assumes this template doesn't show payment_url
 
@@ -161,14 +361,11 @@ def add_product():
             if not all([machine_id_str, name, price_str, stock_str, motor_id_str]):
                 flash("Machine ID, Motor ID, Name, Price, and Stock are required.", 'warning')
                 return render_template('admin/product_form.html', action="Add New", product=request.form) # Pass form back
-            price = float(price_str); stock = int(stock_str); motor_id = int(motor_id_str)
-            if price <= 0 or stock < 0 or motor_id <= 0:
-                 flash("Price/Motor ID must be positive, Stock non-negative.", 'warning')
+            price = _quantize_price(decimal.Decimal(price_str)); stock = int(stock_str); motor_id = int(motor_id_str)
+            if price is None or stock < 0 or motor_id <= 0:
+                 flash("Price must be 0.01-99999999.99, Motor ID positive, Stock non-negative.", 'warning')
                  return render_template('admin/product_form.html', action="Add New", product=request.form)
-            existing = Product.query.filter_by(machine_id=machine_id_str, motor_id=motor_id).first()
-            if existing:
-                flash(f"Motor ID {motor_id} is already used in Machine '{machine_id_str}'.", 'error')
-                return render_template('admin/product_form.html', action="Add New", product=request.form)
+            # Duplicate (machine_id, motor_id) is caught via uq_machine_motor_product on commit (IntegrityError below)
 
             # --- Create and Save (without payment_url) ---
             new_product = Product(
@@ -176,18 +373,18 @@ def add_product():
                 motor_id=motor_id, description=description, image_url=image_url
                 # No payment_url here
             )
-            db.session.add(new_product); db.session.commit()
+            db.session.add(new_product); db.session.commit(); _bump_machine_gen()
             flash(f"Product '{name}' added!", 'success'); return redirect(url_for('list_products'))
-        except ValueError: flash("Invalid number format.", 'danger'); return render_template('admin/product_form.html', action="Add New", product=request.form)
-        except Exception as e: db.session.rollback(); flash(f"Error adding product: {e}", 'danger'); print(f"[ADD PRODUCT ERROR] {e}"); return render_template('admin/product_form.html', action="Add New", product=request.form)
+        except IntegrityError: db.session.rollback(); flash(f"Motor ID {motor_id} is already used in Machine '{machine_id_str}'.", 'error'); return render_template('admin/product_form.html', action="Add New", product=request.form)
+        except (ValueError, decimal.InvalidOperation): flash("Invalid number format.", 'danger'); return render_template('admin/product_form.html', action="Add New", product=request.form)
+        except Exception as e: db.session.rollback(); flash(f"Error adding product: {e}", 'danger'); logger.error("[ADD PRODUCT ERROR] %s", e); return render_template('admin/product_form.html', action="Add New", product=request.form)
     else: return render_template('admin/product_form.html', action="Add New", product=None) # Ensure this template doesn't have payment_url field
 
 @app.route('/admin/product/edit/<int:product_id>', methods=['GET', 'POST'])
 def edit_product(product_id):
-    product = Product.query.get_or_404(product_id)
+    product = _get_or_404(Product, product_id)
     if request.method == 'POST':
         try:
-            original_machine_id = product.machine_id; original_motor_id = product.motor_id
             new_machine_id = request.form.get('machine_id'); name = request.form.get('name')
             price_str = request.form.get('price'); stock_str = request.form.get('stock')
             new_motor_id_str = request.form.get('motor_id'); description = request.form.get('description')
@@ -197,108 +394,136 @@ def edit_product(product_id):
             # --- Validation ---
             if not all([new_machine_id, name, price_str, stock_str, new_motor_id_str]):
                 flash("Machine ID, Motor ID, Name, Price, Stock are required.", 'warning'); return render_template('admin/product_form.html', action="Edit", product=product) # Show original product
-            price = float(price_str); stock = int(stock_str); new_motor_id = int(new_motor_id_str)
-            if price <= 0 or stock < 0 or new_motor_id <= 0:
-                 flash("Price/Motor ID positive, Stock non-negative.", 'warning'); return render_template('admin/product_form.html', action="Edit", product=product)
-            if new_machine_id != original_machine_id or new_motor_id != original_motor_id:
-                existing = Product.query.filter(Product.machine_id == new_machine_id, Product.motor_id == new_motor_id, Product.id != product_id).first()
-                if existing: flash(f"Motor ID {new_motor_id} already used in Machine '{new_machine_id}'.", 'error'); return render_template('admin/product_form.html', action="Edit", product=product)
+            price = _quantize_price(decimal.Decimal(price_str)); stock = int(stock_str); new_motor_id = int(new_motor_id_str)
+            if price is None or stock < 0 or new_motor_id <= 0:
+                 flash("Price must be 0.01-99999999.99, Motor ID positive, Stock non-negative.", 'warning'); return render_template('admin/product_form.html', action="Edit", product=product)
+            # Duplicate (machine_id, motor_id) is caught via uq_machine_motor_product on commit (IntegrityError below)
 
             # --- Update Product Fields (without payment_url) ---
             product.machine_id = new_machine_id; product.name = name; product.price = price; product.stock = stock
             product.motor_id = new_motor_id; product.description = description; product.image_url = image_url
             # No payment_url update here
 
-            db.session.commit(); flash(f"Product '{product.name}' updated!", 'success'); return redirect(url_for('list_products'))
-        except ValueError: flash("Invalid number format.", 'danger'); return render_template('admin/product_form.html', action="Edit", product=product)
-        except Exception as e: db.session.rollback(); flash(f"Error updating product: {e}", 'danger'); print(f"[EDIT PRODUCT ERROR] {e}"); return render_template('admin/product_form.html', action="Edit", product=product)
+            db.session.commit(); _bump_machine_gen(); flash(f"Product '{product.name}' updated!", 'success'); return redirect(url_for('list_products'))
+        except IntegrityError: db.session.rollback(); flash(f"Motor ID {new_motor_id} already used in Machine '{new_machine_id}'.", 'error'); return render_template('admin/product_form.html', action="Edit", product=product)
+        except (ValueError, decimal.InvalidOperation): flash("Invalid number format.", 'danger'); return render_template('admin/product_form.html', action="Edit", product=product)
+        except Exception as e: db.session.rollback(); flash(f"Error updating product: {e}", 'danger'); logger.error("[EDIT PRODUCT ERROR] %s", e); return render_template('admin/product_form.html', action="Edit", product=product)
     else: return render_template('admin/product_form.html', action="Edit", product=product) # Ensure template doesn't show payment_url
 
 @app.route('/admin/product/delete/<int:product_id>', methods=['POST'])
 def delete_product(product_id):
     # (Keep existing delete logic - check for commands/transactions before deleting)
-    product = Product.query.get_or_404(product_id)
+    product = _get_or_404(Product, product_id)
     product_desc = f"'{product.name}' (Machine: {product.machine_id}, Motor: {product.motor_id})"
     try:
-        cmd_exists = VendCommand.query.filter_by(product_id=product_id).first()
-        tran_exists = Transaction.query.filter_by(product_id=product_id).first()
-        if cmd_exists or tran_exists:
+        # One round-trip, no ORM hydration: SELECT EXISTS(...) OR EXISTS(...)
+        has_history = db.session.execute(db.select(
+            db.exists().where(VendCommand.product_id == product_id) | db.exists().where(Transaction.product_id == product_id)
+        )).scalar()
+        if has_history:
              flash(f"Cannot delete {product_desc} - has associated commands/transactions.", 'warning')
              return redirect(url_for('list_products'))
-        db.session.delete(product); db.session.commit()
+        db.session.delete(product); db.session.commit(); _bump_machine_gen()
         flash(f"Product {product_desc} deleted!", 'success')
-    except Exception as e: db.session.rollback(); flash(f"Error deleting product {product_desc}: {e}", 'danger'); print(f"[DELETE PRODUCT ERROR] {e}")
+    except Exception as e: db.session.rollback(); flash(f"Error deleting product {product_desc}: {e}", 'danger'); logger.error("[DELETE PRODUCT ERROR] %s", e)
     return redirect(url_for('list_products'))
 
 
 # --- Vending Machine User Interface ---
-@app.route('/vending/<string:machine_identifier>')
+MACHINE_MISS_RECHECK_SECONDS = 5.0 # an unknown ID re-queries at most this often, so a machine added in another worker shows up quickly
+
+def _is_known_machine(machine_identifier):
+    return (machine_identifier in _get_known_machines()
+            or machine_identifier in _get_known_machines(max_age=MACHINE_MISS_RECHECK_SECONDS))
+
+@app.route('/vending/<machine:machine_identifier>')
 def vending_interface(machine_identifier):
-    try:
-        available_products = Product.query.filter(
-                Product.machine_id == machine_identifier,
-                Product.stock > 0
-            ).order_by(Product.motor_id).all()
-    except Exception as e:
-        print(f"Error fetching products for machine {machine_identifier}: {e}")
-        flash("Error loading products for this machine.", "error")
-        available_products = []
-
-    # Fetch potential commands
-    pending_command = VendCommand.query.filter_by(
-        vend_id=machine_identifier,
-        status='pending' # Waiting for ESP pickup
-    ).order_by(VendCommand.created_at.desc()).first()
-
-    awaiting_payment_command = VendCommand.query.filter_by(
-        vend_id=machine_identifier,
-        status='awaiting_payment' # Waiting for user payment
-    ).order_by(VendCommand.created_at.desc()).first()
-
-    # --- Add current time and threshold for display logic ---
-    now_utc = datetime.now(timezone.utc) # Use timezone-aware UTC time
-    # How long to show the "awaiting payment" message before hiding it (e.g., 10 minutes)
-    awaiting_display_threshold = timedelta(minutes=0.25)
+    if not _is_known_machine(machine_identifier): abort(404) # crawlers/typos: no product or command queries
+    with db.session.no_autoflush: # read-only view, skip the autoflush dirty-set check
+        try:
+            # Lightweight Rows with just the columns the customer template reads: no ORM instance construction,
+            # identity-map bookkeeping or lazy-loadable relationships (so no N+1 possible)
+            available_products = db.session.execute(
+                db.select(Product.id, Product.name, Product.price, Product.stock, Product.motor_id, Product.description, Product.image_url)
+                .where(Product.machine_id == machine_identifier, Product.stock > 0)
+                .order_by(Product.motor_id)
+            ).all()
+        except Exception as e:
+            logger.error("Error fetching products for machine %s: %s", machine_identifier, e)
+            flash("Error loading products for this machine.", "error")
+            available_products = []
+
+        # Fetch potential commands
+        pending_command = VendCommand.query.filter(
+            VendCommand.vend_id == machine_identifier,
+            VendCommand.status.in_(('pending', 'dispatched')) # Paid, waiting for / picked up by ESP
+        ).order_by(VendCommand.created_at.desc()).first()
+
+        # Only surface a RECENT awaiting_payment command; older ones are filtered out in SQL
+        # rather than compared per-request in the template.
+        awaiting_display_threshold = timedelta(seconds=15)
+        awaiting_cutoff = datetime.utcnow() - awaiting_display_threshold # created_at is stored as naive UTC
+        awaiting_payment_command = VendCommand.query.filter_by(
+            vend_id=machine_identifier,
+            status='awaiting_payment' # Waiting for user payment
+        ).filter(VendCommand.created_at > awaiting_cutoff).order_by(VendCommand.created_at.desc()).first()
 
     return render_template('vending_interface.html',
                            machine_id=machine_identifier,
                            products=available_products,
                            pending_command=pending_command,
-                           awaiting_payment_command=awaiting_payment_command,
-                           # --- Pass time variables to template ---
-                           current_time_utc=now_utc,
-                           awaiting_threshold=awaiting_display_threshold
+                           awaiting_payment_command=awaiting_payment_command
                            )
+# --- Buy Route Test Config (built once at import, not per request) ---
+# ===================================================================
+# === VV --- USER: CONFIGURE THESE FOR YOUR TEST --- VV ===
+# ===================================================================
+
+# Dictionary mapping Product IDs to their specific ABA Pay HTTPS links
+# NOTE: You provided the SAME link for both 1 and 2. This code uses that.
+TEST_PRODUCT_LINKS = {
+    1: "https://pay.ababank.com/ehikwoiZBp38PWgo8",  # Link for Product ID 1
+    2: "https://pay.ababank.com/ehikwoiZBp38PWgo8"   # Link for Product ID 2
+    # Add more entries here if testing other products:
+    # 3: "https://pay.ababank.com/ANOTHER_LINK_HERE"
+}
+
+# ===================================================================
+# === ^^ --- USER: CONFIGURE THESE FOR YOUR TEST --- ^^ ===
+# ===================================================================
+
+# Validate the https:// prefix once here instead of on every purchase
+_invalid_test_links = {pid: link for pid, link in TEST_PRODUCT_LINKS.items() if not link.startswith("https://")}
+if _invalid_test_links:
+    raise ValueError(f"TEST_PRODUCT_LINKS entries must start with https://: {_invalid_test_links}")
+
+# --- Buy Route Flash Messages ---
+# Built once; Markup.format() HTML-escapes the arguments, which matters because vending_interface.html
+# renders flashes with |safe (so product names can't inject markup).
+_BUY_OUT_OF_STOCK_FLASH = Markup("Sorry, '{name}' just went out of stock!")
+_BUY_DB_ERROR_FLASH = "An error occurred saving purchase details. Please try again."
+_BUY_REDIRECT_ERROR_FLASH = "Error trying to redirect to payment page. Please try again or pay manually."
+_BUY_MANUAL_PAYMENT_FLASH = Markup("Purchase initiated for '{name}' (Ref: {ref}). Please complete payment manually.")
+
 # --- Buy Route (REFINED TEMPORARY VERSION - HARDCODED HTTPS LINKS TEST) ---
 @app.route('/buy/<int:product_id>', methods=['POST'])
 def buy_product(product_id):
     """
     TEMPORARY TEST VERSION (REFINED):
     - Ensures VendCommand is created with 'awaiting_payment' BEFORE redirect.
-    - If product_id matches a key in TEST_PRODUCT_LINKS, redirects to the hardcoded HTTPS link.
+    - If product_id matches a key in TEST_PRODUCT_LINKS (module level), redirects to the hardcoded HTTPS link.
     - Otherwise, creates command & redirects back to vending page (manual payment needed).
     *** REMEMBER TO REVERT OR CHANGE THIS AFTER TESTING ***
     """
 
-    # ===================================================================
-    # === VV --- USER: CONFIGURE THESE FOR YOUR TEST --- VV ===
-    # ===================================================================
-
-    # Dictionary mapping Product IDs to their specific ABA Pay HTTPS links
-    # NOTE: You provided the SAME link for both 1 and 2. This code uses that.
-    TEST_PRODUCT_LINKS = {
-        1: "https://pay.ababank.com/ehikwoiZBp38PWgo8",  # Link for Product ID 1
-        2: "https://pay.ababank.com/ehikwoiZBp38PWgo8"   # Link for Product ID 2
-        # Add more entries here if testing other products:
-        # 3: "https://pay.ababank.com/ANOTHER_LINK_HERE"
-    }
-
-    # ===================================================================
-    # === ^^ --- USER: CONFIGURE THESE FOR YOUR TEST --- ^^ ===
-    # ===================================================================
-
-    print(f"[BUY-TEST-START] Request for product_id: {product_id}")
-    product = Product.query.get_or_404(product_id)
+    logger.debug("[BUY-TEST-START] Request for product_id: %s", product_id)
+    # Fetch only the columns the buy flow needs as a lightweight Row (no ORM hydration);
+    # the TEXT description and image_url never leave the DB on the purchase path.
+    product = db.session.execute(
+        db.select(Product.id, Product.machine_id, Product.motor_id, Product.name, Product.stock)
+        .where(Product.id == product_id)
+    ).first()
+    if product is None: abort(404)
     machine_id = product.machine_id
     redirect_url_default = url_for('vending_interface', machine_identifier=machine_id)
 
@@ -306,40 +531,31 @@ def buy_product(product_id):
     hardcoded_link_for_product = TEST_PRODUCT_LINKS.get(product_id) # Returns link or None
 
     if hardcoded_link_for_product:
-        print(f"[BUY-TEST-INFO] Product ID {product_id} found in TEST_PRODUCT_LINKS.")
-        # Optional: Basic check if the link looks like a valid HTTPS URL
-        if not hardcoded_link_for_product.startswith("https://"):
-             print(f"[BUY-TEST-ERROR] Hardcoded link for Product ID {product_id} doesn't start with https!: '{hardcoded_link_for_product}'")
-             flash(f"Configuration Error: Test payment link for '{product.name}' is invalid. Contact admin.", "danger")
-             return redirect(redirect_url_default)
+        logger.debug("[BUY-TEST-INFO] Product ID %s found in TEST_PRODUCT_LINKS.", product_id)
     else:
-         print(f"[BUY-TEST-INFO] Product ID {product_id} not found in TEST_PRODUCT_LINKS. Manual payment flow expected.")
+         logger.debug("[BUY-TEST-INFO] Product ID %s not found in TEST_PRODUCT_LINKS. Manual payment flow expected.", product_id)
 
 
     # --- Check Stock ---
     if product.stock <= 0:
-        print(f"[BUY-TEST-WARN] Product {product_id} is out of stock.")
-        flash(f"Sorry, '{product.name}' just went out of stock!", "warning")
+        logger.warning("[BUY-TEST-WARN] Product %s is out of stock.", product_id)
+        flash(_BUY_OUT_OF_STOCK_FLASH.format(name=product.name), "warning")
         return redirect(redirect_url_default)
 
     # --- Database Operations: MUST complete before redirect decision ---
     new_command_id = None
     try:
                # Inside the try block of the /buy route:
-        print(f"[BUY-DB] Preparing DB update for machine {machine_id} (Product {product_id})...")
-        # 1. Cancel previous awaiting commands for THIS machine
-        existing_awaiting_commands = VendCommand.query.filter_by(
-            vend_id=machine_id,
-            status='awaiting_payment'
-        ).with_for_update().all() # Optional lock
-
-        cancelled_count = 0
-        for cmd in existing_awaiting_commands:
-            # Use a clear status name like 'superseded' or stick with 'cancelled_by_new_request'
-            cancelled_status = 'superseded_by_new_request' # Or 'cancelled_by_new_request'
-            print(f"[BUY-DB] Superseding previous awaiting command ID {cmd.id} with status '{cancelled_status}'")
-            cmd.status = cancelled_status
-            cancelled_count += 1
+        logger.debug("[BUY-DB] Preparing DB update for machine %s (Product %s)...", machine_id, product_id)
+        # 1. Cancel previous awaiting commands for THIS machine - one set-based UPDATE, no rows loaded into Python
+        cancelled_status = 'superseded_by_new_request'
+        cancelled_count = db.session.execute(
+            db.update(VendCommand)
+            .where(VendCommand.vend_id == machine_id, VendCommand.status == 'awaiting_payment')
+            .values(status=cancelled_status)
+            .execution_options(synchronize_session=False) # Nothing relevant is loaded in this session
+        ).rowcount
+        if cancelled_count: logger.info("[BUY-DB] Superseded %s previous awaiting command(s) with status '%s'", cancelled_count, cancelled_status)
 
         # 2. Create the new command record (comes after cancelling old ones)
         new_command = VendCommand(
@@ -347,36 +563,36 @@ def buy_product(product_id):
             status='awaiting_payment' # Set status for the new command
         )
         db.session.add(new_command)
-        print(f"[BUY-DB] Added new VendCommand object (pending commit).")
+        logger.debug("[BUY-DB] Added new VendCommand object (pending commit).")
 
         # 3. Commit the transaction (Cancellation AND New Command together)
-        print("[BUY-DB] Attempting db.session.commit()...")
+        logger.debug("[BUY-DB] Attempting db.session.commit()...")
         db.session.commit()
         new_command_id = new_command.id # Get ID after commit
-        print(f"[BUY-DB] COMMIT SUCCESSFUL! New Command ID: {new_command_id}. Superseded {cancelled_count} previous commands.")
+        logger.info("[BUY-DB] COMMIT SUCCESSFUL! New Command ID: %s. Superseded %s previous commands.", new_command_id, cancelled_count)
 
     except Exception as e:
         db.session.rollback()
-        print(f"[BUY-TEST-ERROR] DATABASE EXCEPTION during command creation/cancellation: {e}")
-        flash(f"An error occurred saving purchase details. Please try again.", "danger")
+        logger.error("[BUY-TEST-ERROR] DATABASE EXCEPTION during command creation/cancellation: %s", e)
+        flash(_BUY_DB_ERROR_FLASH, "danger")
         return redirect(redirect_url_default) # Don't proceed if DB failed
 
     # --- Redirect Logic (Only if DB operations were successful) ---
     if hardcoded_link_for_product:
         # DB part succeeded, AND we have a hardcoded link for this product. Redirect.
-        print(f"[BUY-TEST-REDIRECT] Product ID {product_id} is configured for redirect.")
-        print(f"[BUY-TEST-REDIRECT] Attempting redirect to URL: '{hardcoded_link_for_product}'")
+        logger.info("[BUY-TEST-REDIRECT] Product ID %s is configured for redirect.", product_id)
+        logger.debug("[BUY-TEST-REDIRECT] Attempting redirect to URL: '%s'", hardcoded_link_for_product)
         try:
             return redirect(hardcoded_link_for_product)
         except Exception as e:
-            print(f"[BUY-TEST-ERROR] EXCEPTION during redirect call: {e}")
-            flash(f"Error trying to redirect to payment page. Please try again or pay manually.", "warning")
+            logger.error("[BUY-TEST-ERROR] EXCEPTION during redirect call: %s", e)
+            flash(_BUY_REDIRECT_ERROR_FLASH, "warning")
             return redirect(redirect_url_default)
     else:
         # DB part succeeded, but it's NOT a product with a hardcoded link. Redirect back.
-        print(f"[BUY-TEST-INFO] Product ID {product_id} has no hardcoded link. Redirecting back to vending interface.")
+        logger.debug("[BUY-TEST-INFO] Product ID %s has no hardcoded link. Redirecting back to vending interface.", product_id)
         # The VendCommand (ID: new_command_id) IS created with 'awaiting_payment'
-        flash(f"Purchase initiated for '{product.name}' (Ref: {new_command_id}). Please complete payment manually.", "info")
+        flash(_BUY_MANUAL_PAYMENT_FLASH.format(name=product.name, ref=new_command_id), "info")
         return redirect(redirect_url_default)
 
 
@@ -385,67 +601,260 @@ def buy_product(product_id):
 @require_api_key
 def payment_received():
     # (Keep existing payment_received logic - verifies key, gets machine_id from payload, updates status)
-    if not request.is_json: print("[PAYMENT-RECEIVED] Error: Request is not JSON"); return jsonify({"error": "Request must be JSON"}), 400
-    data = request.get_json(); print(f"[PAYMENT-RECEIVED] Received data payload: {data}")
+    if not request.is_json: logger.warning("[PAYMENT-RECEIVED] Error: Request is not JSON"); return _json_static(_JSON_NOT_JSON)
+    data = request.get_json(); logger.debug("[PAYMENT-RECEIVED] Received data payload: %s", data)
     received_machine_id = data.get("machine_id")
-    if not received_machine_id: print("[PAYMENT-RECEIVED] Error: 'machine_id' missing."); return jsonify({"error": "Missing 'machine_id'"}), 400
-    print(f"[PAYMENT-RECEIVED] Processing payment signal for machine_id: '{received_machine_id}'")
+    if not received_machine_id: logger.warning("[PAYMENT-RECEIVED] Error: 'machine_id' missing."); return _json_static(_JSON_NO_MACHINE_ID)
+    logger.debug("[PAYMENT-RECEIVED] Processing payment signal for machine_id: '%s'", received_machine_id)
     try:
         command_to_update = VendCommand.query.filter_by(vend_id=received_machine_id, status='awaiting_payment').order_by(VendCommand.created_at.desc()).first()
         if command_to_update:
-            print(f"[PAYMENT-RECEIVED] Found command ID {command_to_update.id}. Updating status to 'pending'.")
-            command_to_update.status = 'pending'; db.session.commit()
-            print(f"[PAYMENT-RECEIVED] SUCCESS: Updated Command ID {command_to_update.id} to 'pending' for machine '{received_machine_id}'.")
+            logger.debug("[PAYMENT-RECEIVED] Found command ID %s. Updating status to 'pending'.", command_to_update.id)
+            command_to_update.status = 'pending'
+            _notify_vend_pending(received_machine_id) # Delivered to long-poll listeners on commit
+            db.session.commit()
+            logger.info("[PAYMENT-RECEIVED] SUCCESS: Updated Command ID %s to 'pending' for machine '%s'.", command_to_update.id, received_machine_id)
             return jsonify({"message": f"Payment acknowledged. Command {command_to_update.id} for machine {received_machine_id} is now pending."}), 200
         else:
-            print(f"[PAYMENT-RECEIVED] WARNING: No 'awaiting_payment' command found for machine_id '{received_machine_id}'. Signal ignored.")
+            logger.warning("[PAYMENT-RECEIVED] WARNING: No 'awaiting_payment' command found for machine_id '%s'. Signal ignored.", received_machine_id)
             return jsonify({"error": f"No command currently awaiting payment found for machine '{received_machine_id}'."}), 404 # Not Found
-    except Exception as e: db.session.rollback(); print(f"[PAYMENT-RECEIVED] DATABASE ERROR for machine '{received_machine_id}': {e}"); return jsonify({"error": "Internal server error"}), 500
-
+    except Exception as e: db.session.rollback(); logger.error("[PAYMENT-RECEIVED] DATABASE ERROR for machine '%s': %s", received_machine_id, e); return _json_static(_JSON_INTERNAL_ERROR)
+
+
+# --- Long-Poll Support for /get_command (Postgres LISTEN/NOTIFY) ---
+# One background thread LISTENs on a single channel (payload = vend_id) and wakes waiting requests,
+# so idle long-polls don't each pin a DB connection. Only used with Postgres; other DBs fall back to plain polling.
+VEND_NOTIFY_CHANNEL = 'vend_command_pending'
+LONG_POLL_MAX_SECONDS = 25.0
+_long_poll_slots = threading.BoundedSemaphore(CONFIG.long_poll_max_waiters) # no free slot -> answer at once, don't wait
+_vend_notify_cv = threading.Condition()
+_vend_notify_gen = {} # vend_id -> number of notifications seen (waiters wake when it changes)
+_vend_listener_lock = threading.Lock()
+_vend_listener_started = False
+# Idle cache: lets /get_command skip the claim query when this worker's last claim for a vend_id found nothing and no
+# NOTIFY for it has arrived since. Only trusted while the listener is connected (epoch changes on every (re)LISTEN,
+# so notifications missed during a reconnect can't leave a stale entry); entries also expire after a few seconds to
+# cover 'pending' rows written without a NOTIFY.
+VEND_IDLE_CACHE_SECONDS = 10.0
+# The listener proves its connection is alive after this many quiet seconds; a half-open socket (NAT/idle drop with
+# no RST) would otherwise look like "no notifications" forever while the idle cache keeps trusting its epoch.
+VEND_LISTEN_HEARTBEAT_SECONDS = 15.0
+VEND_LISTEN_TCP_USER_TIMEOUT_MS = 10000 # so the heartbeat fails in ~10s on a dead link instead of hanging in TCP retransmits
+VEND_IDLE_CACHE_MAX_ENTRIES = 1024 # vend_id is client-supplied; don't let junk IDs grow this without bound
+_vend_listen_epoch = 0 # 0 = not listening
+_vend_idle = {} # vend_id -> (listen epoch, notify gen, monotonic time) of the last claim that found nothing
+
+def _is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+def _notify_vend_pending(vend_id):
+    # pg_notify with bind params: vend_id comes from the request, never format it into SQL
+    if _is_postgres():
+        db.session.execute(db.text("SELECT pg_notify(:channel, :vend_id)"), {"channel": VEND_NOTIFY_CHANNEL, "vend_id": vend_id})
+
+def _set_tcp_user_timeout(fd, timeout_ms):
+    # Best effort: Linux-only option, and meaningless on a unix-socket DB connection. Without it the heartbeat
+    # still detects drops, just after the OS TCP retransmit timeout.
+    opt = getattr(socket, 'TCP_USER_TIMEOUT', None)
+    if opt is None: return
+    sock = socket.socket(fileno=os.dup(fd)) # dup shares the connection's socket; closing it leaves libpq's fd open
+    try: sock.setsockopt(socket.IPPROTO_TCP, opt, timeout_ms)
+    except OSError as e: logger.debug("[LISTEN] TCP_USER_TIMEOUT not set: %s", e)
+    finally: sock.close()
+
+def _vend_listener_loop(engine):
+    global _vend_listen_epoch
+    epoch = 0
+    while True:
+        try:
+            raw = engine.raw_connection()
+            try:
+                conn = raw.driver_connection # psycopg2 connection
+                conn.autocommit = True
+                _set_tcp_user_timeout(conn.fileno(), VEND_LISTEN_TCP_USER_TIMEOUT_MS)
+                with conn.cursor() as cur: cur.execute(f"LISTEN {VEND_NOTIFY_CHANNEL}")
+                logger.info("[LISTEN] Listening on '%s' for pending commands.", VEND_NOTIFY_CHANNEL)
+                epoch += 1
+                with _vend_notify_cv: _vend_idle.clear(); _vend_listen_epoch = epoch; _vend_notify_cv.notify_all() # waiters re-claim: NOTIFYs may have been missed while down
+                while True:
+                    if select.select([conn], [], [], VEND_LISTEN_HEARTBEAT_SECONDS)[0]: conn.poll()
+                    else: # Quiet period: heartbeat; raises (-> epoch reset + reconnect below) if the connection is dead
+                        with conn.cursor() as cur: cur.execute("SELECT 1")
+                    if conn.notifies: # also collects any that arrived with the heartbeat reply
+                        with _vend_notify_cv:
+                            while conn.notifies:
+                                vend_id = conn.notifies.pop(0).payload
+                                _vend_notify_gen[vend_id] = _vend_notify_gen.get(vend_id, 0) + 1
+                            _vend_notify_cv.notify_all()
+            finally:
+                with _vend_notify_cv: _vend_listen_epoch = 0; _vend_notify_cv.notify_all()
+                raw.invalidate() # Don't hand a LISTENing autocommit connection back to the pool
+        except Exception as e:
+            logger.error("[LISTEN] Listener error: %s. Reconnecting in 5s.", e)
+            time.sleep(5)
+
+def _ensure_vend_listener():
+    global _vend_listener_started
+    if _vend_listener_started: return
+    with _vend_listener_lock:
+        if not _vend_listener_started:
+            threading.Thread(target=_vend_listener_loop, args=(db.engine,), daemon=True, name='vend-listener').start()
+            _vend_listener_started = True
+
+def _vend_known_idle(vend_id, gen):
+    # Caller holds _vend_notify_cv
+    entry = _vend_idle.get(vend_id)
+    return (entry is not None and _vend_listen_epoch != 0 and entry[0] == _vend_listen_epoch and entry[1] == gen
+            and time.monotonic() - entry[2] < VEND_IDLE_CACHE_SECONDS)
+
+def _mark_vend_idle(vend_id, epoch, gen):
+    # epoch/gen are the values read BEFORE the claim query, so a NOTIFY or reconnect during the query invalidates the entry
+    with _vend_notify_cv:
+        if epoch == 0 or epoch != _vend_listen_epoch: return
+        if len(_vend_idle) >= VEND_IDLE_CACHE_MAX_ENTRIES and vend_id not in _vend_idle: _vend_idle.clear()
+        _vend_idle[vend_id] = (epoch, gen, time.monotonic())
+
+def _wait_for_vend_notification(vend_id, seen_gen, seen_epoch, deadline):
+    # Wakes on a NOTIFY for vend_id OR a listener epoch change (disconnect/reconnect: NOTIFYs sent in the gap are lost,
+    # so the caller must re-claim). Returns the new (gen, epoch) to wait from next, or None once the deadline passes.
+    with _vend_notify_cv:
+        while _vend_notify_gen.get(vend_id, 0) == seen_gen and _vend_listen_epoch == seen_epoch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: return None
+            _vend_notify_cv.wait(remaining)
+        return _vend_notify_gen.get(vend_id, 0), _vend_listen_epoch
+
+
+# --- ESP32 Interaction Routes ---
+def _claim_pending_command(vend_id):
+    # Single Core statement, no ORM hydration: UPDATE ... SET status='dispatched' WHERE id = (oldest 'pending' row,
+    # locked with SKIP LOCKED so concurrent pollers never get the same one) RETURNING id, motor_id.
+    # Returns (command_id, motor_id) or None.
+    vend_command = VendCommand.__table__
+    next_pending_id = (
+        db.select(vend_command.c.id)
+        .where(vend_command.c.vend_id == vend_id, vend_command.c.status == 'pending')
+        .order_by(vend_command.c.created_at.asc()).limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    row = db.session.execute(
+        db.update(vend_command).where(vend_command.c.id == next_pending_id)
+        .values(status='dispatched').returning(vend_command.c.id, vend_command.c.motor_id)
+    ).first()
+    db.session.commit() # Also releases the pooled connection when nothing was claimed
+    return (row.id, row.motor_id) if row else None
 
-# --- ESP32 Interaction Routes (Unchanged) ---
 @app.route('/get_command', methods=['GET'])
 def get_command():
-    # (Keep existing get_command logic - finds oldest 'pending' command for vend_id)
+    # Claims oldest 'pending' command for vend_id (status -> 'dispatched'). Optional '?wait=<seconds>' (max 25) long-polls:
+    # if nothing is pending, the request blocks until /payment-received NOTIFYs this vend_id or the wait expires.
+    # Waiters per worker are capped (LONG_POLL_MAX_WAITERS); when all slots are taken the poll is answered immediately.
+    # On Postgres, repeat polls with nothing new NOTIFYed since the last empty claim are answered without a query.
     req_vend_id = request.args.get('vend_id')
-    if not req_vend_id: print("[GET_COMMAND] Error: vend_id missing"); return jsonify({"error": "vend_id is required"}), 400
-    print(f"[GET_COMMAND] Request from vend_id: {req_vend_id}")
+    if not req_vend_id: logger.warning("[GET_COMMAND] Error: vend_id missing"); return _json_static(_JSON_NO_VEND_ID)
+    wait_seconds = min(max(request.args.get('wait', default=0.0, type=float), 0.0), LONG_POLL_MAX_SECONDS)
+    logger.debug("[GET_COMMAND] Request from vend_id: %s", req_vend_id)
     try:
-        command = VendCommand.query.filter_by(vend_id=req_vend_id, status='pending').order_by(VendCommand.created_at.asc()).first()
-        if command: print(f"[GET_COMMAND] Found pending cmd ID: {command.id} Motor: {command.motor_id}"); return jsonify({"motor_id": command.motor_id, "command_id": command.id})
-        else: print(f"[GET_COMMAND] No pending commands for vend_id: {req_vend_id}"); return jsonify({"motor_id": None, "command_id": None})
-    except Exception as e: print(f"[GET_COMMAND] DB error for vend_id {req_vend_id}: {e}"); return jsonify({"error": "Database error"}), 500
+        use_notify = _is_postgres()
+        known_idle = False
+        if use_notify:
+            _ensure_vend_listener()
+            with _vend_notify_cv: # Read BEFORE the SELECT so no NOTIFY is missed
+                seen_gen = _vend_notify_gen.get(req_vend_id, 0); epoch = _vend_listen_epoch
+                known_idle = _vend_known_idle(req_vend_id, seen_gen)
+        claimed = None if known_idle else _claim_pending_command(req_vend_id)
+        if not claimed and use_notify:
+            if not known_idle: _mark_vend_idle(req_vend_id, epoch, seen_gen)
+            if wait_seconds > 0 and _long_poll_slots.acquire(blocking=False):
+                try:
+                    deadline = time.monotonic() + wait_seconds
+                    while not claimed and (woke := _wait_for_vend_notification(req_vend_id, seen_gen, epoch, deadline)):
+                        seen_gen, epoch = woke # taken BEFORE the re-claim, so anything after it wakes us again
+                        claimed = _claim_pending_command(req_vend_id)
+                finally: _long_poll_slots.release()
+        if claimed: command_id, motor_id = claimed; logger.info("[GET_COMMAND] Dispatched cmd ID: %s Motor: %s", command_id, motor_id); return jsonify({"motor_id": motor_id, "command_id": command_id})
+        else: logger.debug("[GET_COMMAND] No pending commands for vend_id: %s", req_vend_id); return _json_static(_JSON_NO_COMMAND)
+    except Exception as e: db.session.rollback(); logger.error("[GET_COMMAND] DB error for vend_id %s: %s", req_vend_id, e); return _json_static(_JSON_DB_ERROR)
+
+# Postgres happy path for a success ACK: claim the command and decrement stock in ONE statement
+# (data-modifying CTEs), closing the check-then-decrement race. price is NULL when stock was already 0.
+# No row back means the command is missing / for another machine / already processed.
+_ACK_SUCCESS_SQL = db.text("""
+    WITH cmd AS (
+        UPDATE vend_command SET status = 'acknowledged_success', acknowledged_at = :ack_time
+        WHERE id = :command_id AND vend_id = :vend_id AND status IN ('dispatched', 'pending')
+        RETURNING product_id
+    ), prod AS (
+        UPDATE product SET stock = product.stock - 1 FROM cmd
+        WHERE product.id = cmd.product_id AND product.stock > 0
+        RETURNING product.id, product.stock, product.price
+    )
+    SELECT cmd.product_id, prod.stock, prod.price FROM cmd LEFT JOIN prod ON prod.id = cmd.product_id
+""")
+
+_VALID_ACK_STATUSES = frozenset(("success", "failure"))
+_ACKABLE_COMMAND_STATUSES = frozenset(("dispatched", "pending"))
+
+def _ack_failure(command_id, vend_id, ack_time):
+    # Failure ACK in one guarded UPDATE ... RETURNING (no stock change: stock is only taken on success).
+    # Returns False when the command is missing / for another machine / already processed.
+    vend_command = VendCommand.__table__
+    return db.session.execute(
+        db.update(vend_command)
+        .where(vend_command.c.id == command_id, vend_command.c.vend_id == vend_id, vend_command.c.status.in_(_ACKABLE_COMMAND_STATUSES))
+        .values(status="acknowledged_failure", acknowledged_at=ack_time).returning(vend_command.c.id)
+    ).first() is not None
 
 @app.route('/acknowledge', methods=['POST'])
 def acknowledge():
     # (Keep existing acknowledge logic - updates command status, decrements stock, logs transaction)
-    if not request.is_json: print("[ACK] Error: Not JSON"); return jsonify({"error": "Request must be JSON"}), 400
-    data = request.get_json(); print(f"[ACK] Received data: {data}")
+    if not request.is_json: logger.warning("[ACK] Error: Not JSON"); return _json_static(_JSON_NOT_JSON)
+    data = request.get_json(); logger.debug("[ACK] Received data: %s", data)
     req_command_id = data.get("command_id"); req_vend_id = data.get("vend_id"); req_motor_id = data.get("motor_id"); req_status = data.get("status")
-    if not all([req_command_id, req_vend_id, req_motor_id is not None, req_status]): print(f"[ACK] Error: Missing fields."); return jsonify({"error": "Missing fields"}), 400
-    if req_status not in ["success", "failure"]: print(f"[ACK] Error: Invalid status '{req_status}'."); return jsonify({"error": "Invalid status"}), 400
+    if not all([req_command_id, req_vend_id, req_motor_id is not None, req_status]): logger.warning("[ACK] Error: Missing fields."); return _json_static(_JSON_ACK_MISSING_FIELDS)
+    # Reject wrongly-typed IDs up front: they would otherwise reach the DB, fail there, roll back and come back as a 500
+    if type(req_command_id) is str and req_command_id.isascii() and req_command_id.isdigit(): req_command_id = int(req_command_id)
+    if type(req_command_id) is not int or not isinstance(req_vend_id, str): logger.warning("[ACK] Error: Invalid field types."); return _json_static(_JSON_ACK_BAD_FIELDS)
+    if not isinstance(req_status, str) or req_status not in _VALID_ACK_STATUSES: logger.warning("[ACK] Error: Invalid status '%s'.", req_status); return _json_static(_JSON_ACK_BAD_STATUS) # isinstance first: a JSON list/object is unhashable
     try:
+        if req_status == "success" and _is_postgres():
+            ack_time = datetime.utcnow()
+            row = db.session.execute(_ACK_SUCCESS_SQL, {"ack_time": ack_time, "command_id": req_command_id, "vend_id": req_vend_id}).first()
+            if row is not None:
+                logger.debug("[ACK] Processing SUCCESS for Command %s", req_command_id)
+                if row.price is not None: logger.info("   - Decremented stock for Prod %s to %s", row.product_id, row.stock); db.session.add(Transaction(product_id=row.product_id, quantity=1, amount_paid=row.price, timestamp=ack_time)); logger.debug("   - Logged transaction.")
+                else: logger.warning("   - WARNING: Success ACK but Prod %s stock was 0!", row.product_id); db.session.execute(db.update(VendCommand).where(VendCommand.id == req_command_id).values(status="acknowledged_success_stock_error"))
+                db.session.commit(); logger.info("[ACK] Successfully processed ACK for Cmd %s", req_command_id); return _json_static(_JSON_ACK_OK)
+            # Fall through: the ORM path below reports why the command couldn't be acknowledged
+        elif req_status == "failure" and _ack_failure(req_command_id, req_vend_id, datetime.utcnow()):
+            logger.info("[ACK] Processing FAILURE for Cmd %s", req_command_id); logger.debug("   - Marked as failed.")
+            db.session.commit(); logger.info("[ACK] Successfully processed ACK for Cmd %s", req_command_id); return _json_static(_JSON_ACK_OK)
+
         command = db.session.get(VendCommand, req_command_id)
-        if not command: print(f"[ACK] Error: Command ID {req_command_id} not found."); return jsonify({"error": "Command not found"}), 404
-        if command.vend_id != req_vend_id: print(f"[ACK] Error: Mismatched vend_id."); return jsonify({"error": "Vending machine ID mismatch"}), 400
-        if command.status != 'pending': print(f"[ACK] Info: Command {req_command_id} not pending (Status: {command.status}). Ignoring."); return jsonify({"message": f"Command already processed (status: {command.status})"}), 200
+        if not command: logger.warning("[ACK] Error: Command ID %s not found.", req_command_id); return _json_static(_JSON_ACK_NOT_FOUND)
+        if command.vend_id != req_vend_id: logger.warning("[ACK] Error: Mismatched vend_id."); return _json_static(_JSON_ACK_VEND_MISMATCH)
+        if command.status not in _ACKABLE_COMMAND_STATUSES: logger.info("[ACK] Info: Command %s not dispatched/pending (Status: %s). Ignoring.", req_command_id, command.status); return jsonify({"message": f"Command already processed (status: {command.status})"}), 200
 
-        product = db.session.get(Product, command.product_id); ack_time = datetime.utcnow(); command.acknowledged_at = ack_time
+        ack_time = datetime.utcnow(); command.acknowledged_at = ack_time
         if req_status == "success":
-            print(f"[ACK] Processing SUCCESS for Command {req_command_id}")
+            logger.debug("[ACK] Processing SUCCESS for Command %s", req_command_id)
             command.status = "acknowledged_success"
-            if product:
-                if product.stock > 0: product.stock -= 1; print(f"   - Decremented stock for Prod {product.id} to {product.stock}"); transaction = Transaction(product_id=product.id, quantity=1, amount_paid=product.price, timestamp=ack_time); db.session.add(transaction); print(f"   - Logged transaction.")
-                else: print(f"   - WARNING: Success ACK but Prod {product.id} stock was 0!"); command.status = "acknowledged_success_stock_error"
-            else: print(f"   - ERROR: Product {command.product_id} not found!"); command.status = "acknowledged_success_product_missing"
-        elif req_status == "failure": print(f"[ACK] Processing FAILURE for Cmd {req_command_id}"); command.status = "acknowledged_failure"; print(f"   - Marked as failed.")
-        db.session.commit(); print(f"[ACK] Successfully processed ACK for Cmd {req_command_id}"); return jsonify({"message": "Acknowledgment received"}), 200
-    except Exception as e: db.session.rollback(); print(f"[ACK] DATABASE ERROR processing Cmd {req_command_id}: {e}"); return jsonify({"error": "Database error during acknowledgment"}), 500
+            # Single guarded UPDATE ... RETURNING: atomic decrement, no read-modify-write race on stock
+            updated = db.session.execute(
+                db.update(Product).where(Product.id == command.product_id, Product.stock > 0)
+                .values(stock=Product.stock - 1).returning(Product.stock, Product.price)
+            ).first()
+            if updated: logger.info("   - Decremented stock for Prod %s to %s", command.product_id, updated.stock); transaction = Transaction(product_id=command.product_id, quantity=1, amount_paid=updated.price, timestamp=ack_time); db.session.add(transaction); logger.debug("   - Logged transaction.")
+            else: logger.warning("   - WARNING: Success ACK but Prod %s stock was 0!", command.product_id); command.status = "acknowledged_success_stock_error"
+        elif req_status == "failure": logger.info("[ACK] Processing FAILURE for Cmd %s", req_command_id); command.status = "acknowledged_failure"; logger.debug("   - Marked as failed.")
+        db.session.commit(); logger.info("[ACK] Successfully processed ACK for Cmd %s", req_command_id); return _json_static(_JSON_ACK_OK)
+    except Exception as e: db.session.rollback(); logger.error("[ACK] DATABASE ERROR processing Cmd %s: %s", req_command_id, e); return _json_static(_JSON_ACK_DB_ERROR)
 
 
 # --- Run Block ---
 if __name__ == '__main__':
-    port = int(os.environ.get('PORT', 5000))
-    debug_mode = os.environ.get('FLASK_DEBUG', '0') == '1'
-    print(f"Starting Flask server on http://0.0.0.0:{port} with debug={debug_mode}")
+    port = CONFIG.port
+    debug_mode = CONFIG.debug
+    logger.info("Starting Flask server on http://0.0.0.0:%s with debug=%s", port, debug_mode)
     app.run(host='0.0.0.0', port=port, debug=debug_mode)
\ No newline at end of file
@@ -0,0 +1,19 @@
+import os
+
+# --- Gunicorn Config (production server; `python app.py` is only for local dev) ---
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# Small fixed default: os.cpu_count() reports the host's cores, not the container's CPU quota, and every worker carries
+# its own DB pool + LISTEN connection. Raise via WEB_CONCURRENCY (keep total DB connections under Postgres max_connections).
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = 'gthread'
+# Each /get_command?wait=... long-poll occupies one thread while waiting. app.py caps concurrent waiters per worker at
+# LONG_POLL_MAX_WAITERS (default GUNICORN_THREADS // 4, min 1); keep it well below this so other requests always have threads.
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+keepalive = 75 # ESP32s poll repeatedly; outlast the ~60s idle timeout of the fronting proxy so it never reuses a socket we just closed
+# Worker heartbeat files in RAM: a disk-backed /tmp (e.g. on container overlay filesystems) can stall workers on fsync
+if os.path.isdir('/dev/shm'): worker_tmp_dir = '/dev/shm'
+
+# Load app.py (dotenv, config, SQLAlchemy models) once in the master and share it with workers via fork.
+# Nothing connects to the DB at import, and the LISTEN thread starts lazily per worker.
+preload_app = True
@@ -0,0 +1,2 @@
+# WSGI entry point for gunicorn (see gunicorn.conf.py / Procfile): gunicorn -c gunicorn.conf.py wsgi:app
+from app import app